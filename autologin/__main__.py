@@ -1,110 +1,389 @@
-from abc import ABC, abstractmethod
 from argparse import ArgumentParser
-from configparser import ConfigParser
+from configparser import ConfigParser, Error as ConfigError
+from dataclasses import dataclass, field
 from datetime import timedelta
+from functools import lru_cache
+from html import unescape
+from http.client import HTTPConnection, HTTPException, HTTPResponse
 import os
 import random
+import re
+import socket
 import sys
-from time import sleep
-from typing import Dict, Type
-from urllib.parse import urljoin
+from time import monotonic, sleep
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Type, Union
+from urllib.parse import urljoin, urlsplit, urlunsplit
+from urllib.request import getproxies, proxy_bypass
 
-import requests
-from bs4 import BeautifulSoup
+if TYPE_CHECKING:
+    import requests
 
-# Urls and contents used to check if we are blocked
-PORTAL_DETECT_URLS: Dict[str, str] = {
+# Urls and contents used to check if we are blocked, None meaning that the url
+# answers with an empty 204 response when we're online
+PORTAL_DETECT_URLS: Dict[str, Optional[str]] = {
+    "http://connectivitycheck.gstatic.com/generate_204": None,
     "http://detectportal.firefox.com/canonical.html": '<meta http-equiv="refresh" content="0;url=https://support.mozilla.org/kb/captive-portal"/>',
     "http://nmcheck.gnome.org/check_network_status.txt": "NetworkManager is online",
     "http://ping.archlinux.org/": "This domain is used for connectivity checking (captive portal detection).",
 }
 
+# Same as above, precomputed once with the expected contents as bytes
+_DETECT: Tuple[Tuple[str, Optional[bytes]], ...] = tuple(
+    (url, None if expected is None else expected.encode())
+    for url, expected in PORTAL_DETECT_URLS.items()
+)
+
 CHECK_PERIOD = timedelta(seconds=60)
 
+# How long DNS answers for the detection hosts are kept
+DNS_CACHE_TTL = timedelta(seconds=300)
+
+# (connect, read) timeouts in seconds for every HTTP request made by autologin
+REQUEST_TIMEOUT = (3.0, 5.0)
+
 CONFIG_EXPECTED_PATHS = [
     "~/.config/autologin/config.ini",
     "~/.autologin.ini",
     "/etc/autologin.ini",
 ]
 
+_RESOLVED_PATHS = tuple(os.path.expanduser(path) for path in CONFIG_EXPECTED_PATHS)
+
+
+@dataclass(frozen=True)
+class ULCOConfig:
+    """Settings of the [portal.ulco] section."""
+
+    is_internal: bool
+    # Only required when actually logging in to the portal
+    login: Optional[str]
+    password: Optional[str] = field(repr=False)
+
+
+@dataclass(frozen=True)
+class Config:
+    """Settings extracted once from the configuration file."""
 
-class PortalHandler(ABC):
-    def __init__(self, config: ConfigParser) -> None:
+    update_period: float
+    ulco: ULCOConfig
+
+
+class UnexpectedResponse(HTTPException):
+    """A detection url answered with something telling nothing about a portal."""
+
+
+class PortalHandler:
+    __slots__ = ("_config", "_session")
+
+    def __init__(self, config: Config, session: "requests.Session") -> None:
         self._config = config
+        self._session = session
 
-    @abstractmethod
     def login(self, url: str, portal: str) -> None:
-        ...
+        raise NotImplementedError
 
 
 class ULCOPortalHandler(PortalHandler):
+    __slots__ = ()
+
+    # The CAS login page is small and stable, no need to build a whole DOM
+    _LT_RE = re.compile(rb'name="lt"\s+value="([^"]+)"')
+    _ACTION_RE = re.compile(rb'<form[^>]*\saction="([^"]+)"', re.I)
+    # Constant part of the CAS login form
+    _STATIC_FORM = (("_eventId", "submit"), ("submit", "SE CONNECTER"))
+
     body_criteria = ["<title>ULCO Portail Captif</title>"]
     url_criteria = ["https://eduspot.univ-littoral.fr/"]
     config_section = "portal.ulco"
 
     def login(self, url: str, portal: str) -> None:
-        session = requests.Session()
-        if self._config.getboolean("portal.ulco", "is_internal_account", fallback=True):
+        session = self._session
+        # Start from an empty cookie jar to avoid leaking cookies between logins
+        session.cookies.clear()
+        config = self._config.ulco
+        if config.login is None or config.password is None:
+            raise RuntimeError("Missing login or password in [portal.ulco]")
+        if config.is_internal:
             session.cookies.set(
                 "kanet-choice", "cas", domain="univ-littoral.fr", path="/"
             )
             print(portal)
             response = session.get(
-                "https://auth.univ-littoral.fr/cas/login?service=https://eduspot.univ-littoral.fr/login_cas/"
+                "https://auth.univ-littoral.fr/cas/login?service=https://eduspot.univ-littoral.fr/login_cas/",
+                timeout=REQUEST_TIMEOUT,
             )
-            soup = BeautifulSoup(response.content, "lxml")
-            form = soup.find("form")
-            parameters = {
-                "username": self._config.get("portal.ulco", "login"),
-                "password": self._config.get("portal.ulco", "password"),
-                "lt": form.find("input", attrs={"name": "lt"})["value"],
-                "_eventId": "submit",
-                "submit": "SE CONNECTER",
-            }
-            submit_url = urljoin(response.url, form["action"])
-            response = session.post(submit_url, parameters)
+            body = response.content
+            lt_match = self._LT_RE.search(body)
+            action_match = self._ACTION_RE.search(body)
+            if lt_match is None or action_match is None:
+                raise RuntimeError("Could not find the CAS login form")
+            parameters = [
+                ("username", config.login),
+                ("password", config.password),
+                ("lt", unescape(lt_match.group(1).decode())),
+                *self._STATIC_FORM,
+            ]
+            submit_url = urljoin(response.url, unescape(action_match.group(1).decode()))
+            response = session.post(submit_url, parameters, timeout=REQUEST_TIMEOUT)
             if not response.ok:
                 raise RuntimeError("Invalid login or password")
             response = session.post(
-                urljoin(response.url, "../update/"), {"httpredirect": False}
+                urljoin(response.url, "../update/"),
+                {"httpredirect": False},
+                timeout=REQUEST_TIMEOUT,
             )
         else:
             raise RuntimeError("Renater accounts are not yet supported")
 
 
+@lru_cache(maxsize=None)
+def _get_session() -> "requests.Session":
+    """Return the session shared by portal fetches and logins.
+
+    requests is only imported here, as it isn't needed while we're online.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        # POST is not retried by default, so we never submit a login twice
+        max_retries=Retry(
+            total=2, backoff_factor=0.3, status_forcelist=(502, 503, 504)
+        ),
+        pool_connections=4,
+        pool_maxsize=8,
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 def get_portal_handler(url: str, portal: str) -> Type[PortalHandler]:
     """Return a PortalHandler based on the portal's contents."""
     # TODO detect portal, for now only support for ULCO's portal
     return ULCOPortalHandler
 
 
-def login(config: ConfigParser, url: str, portal: str) -> None:
+def login(config: Config, url: str, portal: str) -> None:
     """Select a portal handler, and then call the login method."""
     portal_handler = get_portal_handler(url, portal)
     print(f"Detected portal of type {portal_handler.__name__}.")
-    portal_handler(config).login(url, portal)
+    portal_handler(config, _get_session()).login(url, portal)
+
+
+_DETECT_HOSTS = frozenset(urlsplit(url).hostname for url, _ in _DETECT)
+
+# getaddrinfo results for the detection hosts, along with their expiry time
+_DNS_CACHE: Dict[Tuple[Any, ...], Tuple[float, List[Tuple[Any, ...]]]] = {}
+_getaddrinfo = socket.getaddrinfo
+
+
+def _cached_getaddrinfo(
+    host: Optional[str],
+    port: Union[str, int, None],
+    family: int = 0,
+    type: int = 0,
+    proto: int = 0,
+    flags: int = 0,
+) -> List[Tuple[Any, ...]]:
+    """Wrap socket.getaddrinfo, caching the answers for the detection hosts."""
+    if host not in _DETECT_HOSTS:
+        return _getaddrinfo(host, port, family, type, proto, flags)
+    key = (host, port, family, type, proto, flags)
+    now = monotonic()
+    cached = _DNS_CACHE.get(key)
+    if cached is None or cached[0] <= now:
+        result = _getaddrinfo(host, port, family, type, proto, flags)
+        cached = _DNS_CACHE[key] = (now + DNS_CACHE_TTL.total_seconds(), result)
+    # Callers get their own list, so they can't alter the cached one
+    return list(cached[1])
+
+
+# Kept-alive connections used to probe the detection hosts, keyed by host,
+# along with whether they go through a proxy
+_CONNS: Dict[str, Tuple[HTTPConnection, bool]] = {}
+
+
+def _connect(url: str) -> Tuple[HTTPConnection, bool]:
+    """Open a connection for a detection url, going through the http proxy if any.
 
+    Return the connection, and whether it goes through a proxy.
+    """
+    parts = urlsplit(url)
+    address = parts.netloc
+    proxy = getproxies().get("http")
+    proxied = False
+    if proxy and not proxy_bypass(parts.hostname or ""):
+        proxied = True
+        if "://" not in proxy:
+            proxy = "http://" + proxy
+        # Proxy credentials aren't supported, only keep the host and port
+        address = urlsplit(proxy).netloc.rpartition("@")[2]
+    conn = HTTPConnection(address, timeout=REQUEST_TIMEOUT[0])
+    conn.connect()
+    # Connected, switch from the connect timeout to the read timeout
+    conn.sock.settimeout(REQUEST_TIMEOUT[1])
+    return conn, proxied
 
-def check_online(config: ConfigParser) -> None:
-    """Check if the computer is online, and login if a portal is detected."""
-    url, expected_content = random.choice(list(PORTAL_DETECT_URLS.items()))
+
+def _request(url: str) -> HTTPResponse:
+    """GET a detection url, reusing the connection to its host if possible."""
+    parts = urlsplit(url)
+    cached = _CONNS.get(parts.netloc)
+    # The connection is closed when the server asked for it in a response
+    if cached is None or cached[0].sock is None:
+        cached = _CONNS[parts.netloc] = _connect(url)
+        retry = False
+    else:
+        retry = True
+    conn, proxied = cached
+    # Proxies expect the absolute url, servers only the path
+    target = url
+    if not proxied:
+        target = urlunsplit(("", "", parts.path or "/", parts.query, ""))
     try:
-        # allow_redirects defaults to True, but it's better to be explicit
-        result = requests.get(url, allow_redirects=True)
-    except requests.RequestException:
-        print("Network error, probably offline")
-        return
-    if result.text.strip() == expected_content:
-        print("Computer is online")
+        conn.request("GET", target)
+        return conn.getresponse()
+    except ConnectionError:
+        if not retry:
+            raise
+        # The server closed the idle connection, reconnect once
+        conn.close()
+    conn, _ = _CONNS[parts.netloc] = _connect(url)
+    conn.request("GET", target)
+    return conn.getresponse()
+
+
+def _drop_connection(host: str) -> None:
+    """Close and forget the connection to a detection host, if any."""
+    cached = _CONNS.pop(host, None)
+    if cached is not None:
+        cached[0].close()
+
+
+def _probe(url: str, expected_content: Optional[bytes]) -> Optional[Tuple[str, str]]:
+    """Probe a detection url, return the portal's url and contents if blocked.
+
+    Raise UnexpectedResponse when the answer doesn't tell whether we're
+    behind a portal.
+    """
+    host = urlsplit(url).netloc
+    redirect = None
+    try:
+        response = _request(url)
+        location = response.getheader("Location")
+        if 300 <= response.status < 400 and location:
+            response.read()
+            redirect = urljoin(url, location)
+        elif expected_content is None:
+            # A 204 has no body, so this costs as much as a HEAD would
+            body = response.read()
+            if response.status == 204:
+                return None
+        else:
+            # Only read what's needed to compare, a portal page can be big
+            body = response.read(len(expected_content) + 16)
+            if body.strip() == expected_content:
+                if not response.isclosed():
+                    # The body wasn't fully read, the connection can't be reused
+                    _drop_connection(host)
+                return None
+            body += response.read()
+        if redirect is None and (response.status != 200 or not body.strip()):
+            # Could be a proxy or middlebox, let another url decide
+            raise UnexpectedResponse(f"unexpected {response.status} status")
+    except (HTTPException, OSError):
+        _drop_connection(host)
+        raise
+    # The portal might have answered our DNS queries, don't trust them
+    _DNS_CACHE.clear()
+    if redirect is not None:
+        return _fetch_portal(redirect)
+    # The portal intercepted the request and answered itself, keep that page
+    # as fetching it again could give another answer
+    charset = response.msg.get_content_charset() or "utf-8"
+    try:
+        return url, body.decode(charset, "replace")
+    except LookupError:
+        # Unknown charset announced by the portal
+        return url, body.decode("utf-8", "replace")
+
+
+def _fetch_portal(url: str) -> Tuple[str, str]:
+    """Return the url and contents of the portal we're redirected to."""
+    # allow_redirects defaults to True, but it's better to be explicit
+    result = _get_session().get(url, allow_redirects=True, timeout=REQUEST_TIMEOUT)
+    return result.url, result.text
+
+
+def check_online(config: Config) -> None:
+    """Check if the computer is online, and login if a portal is detected.
+
+    The 204 urls are tried first, then the other detection urls in a random
+    order, falling back to the next one when a request fails or is
+    inconclusive, so that a single unreachable endpoint does not make us
+    think we're offline.
+    """
+    # The 204 urls are the cheapest to check, so they're tried first
+    candidates = sorted(
+        random.sample(_DETECT, len(_DETECT)), key=lambda item: item[1] is not None
+    )
+    for url, expected_content in candidates:
+        try:
+            portal = _probe(url, expected_content)
+        except UnexpectedResponse as error:
+            print(f"Inconclusive answer from {url!r} ({error}), trying another url.")
+            continue
+        # requests.RequestException is a subclass of OSError
+        except (HTTPException, OSError):
+            print(f"Network error while reaching {url!r}, trying another url.")
+            _DNS_CACHE.clear()
+            continue
+        if portal is None:
+            print("Computer is online")
+            return
+        print("Did not match expected content, trying to log-in.")
+        try:
+            login(config, *portal)
+        # requests.RequestException is a subclass of OSError
+        except OSError as error:
+            print(f"Network error while logging in, retrying next check: {error}")
+        # Answers cached while the portal was intercepting are stale now
+        _DNS_CACHE.clear()
         return
-    print("Did not match expected content, trying to log-in.")
-    login(config, result.url, result.text)
+    print("Network error, probably offline")
+
 
+# Parsed configs, keyed by path, along with the (mtime, size) they were read at
+_CFG_CACHE: Dict[str, Tuple[Tuple[int, int], Config]] = {}
 
-def load_config(path: str) -> ConfigParser:
-    """Load a config from a given path."""
-    config = ConfigParser()
-    config.read(path)
+
+def load_config(path: str) -> Config:
+    """Load a config from a given path, reusing the cached one if unchanged."""
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _CFG_CACHE.get(path)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    parser = ConfigParser()
+    # Unlike ConfigParser.read, this doesn't silently skip unreadable files
+    with open(path) as config_file:
+        parser.read_file(config_file)
+    config = Config(
+        update_period=parser.getint(
+            "general", "update_period", fallback=CHECK_PERIOD.total_seconds()
+        ),
+        ulco=ULCOConfig(
+            is_internal=parser.getboolean(
+                "portal.ulco", "is_internal_account", fallback=True
+            ),
+            login=parser.get("portal.ulco", "login", fallback=None),
+            password=parser.get("portal.ulco", "password", fallback=None),
+        ),
+    )
+    _CFG_CACHE[path] = (key, config)
     return config
 
 
@@ -115,19 +394,26 @@ def main():
 
     args = parser.parse_args()
 
-    config: Optional[ConfigParser] = None
+    config: Optional[Config] = None
 
-    if args.configuration_path is not None:
-        path = args.configuration_path[0]
-        if not os.path.exists(path):
-            print(f"Config file {path!r} not found.")
-            sys.exit(1)
-        config = load_config(path)
-    else:
-        for path in CONFIG_EXPECTED_PATHS:
-            if os.path.exists(path):
+    try:
+        if args.configuration_path is not None:
+            path = args.configuration_path[0]
+            try:
                 config = load_config(path)
+            except FileNotFoundError:
+                print(f"Config file {path!r} not found.")
+                sys.exit(1)
+        else:
+            for path in _RESOLVED_PATHS:
+                try:
+                    config = load_config(path)
+                except FileNotFoundError:
+                    continue
                 break
+    except (OSError, ValueError, ConfigError) as error:
+        print(f"Could not load config file {path!r}: {error}")
+        sys.exit(1)
 
     if config is None:
         print(
@@ -138,16 +424,28 @@ def main():
             print("-", path)
         sys.exit(1)
 
-    print("autologin started")
+    socket.getaddrinfo = _cached_getaddrinfo
 
-    sleep_duration = config.getint(
-        "general", "update_period", fallback=CHECK_PERIOD.total_seconds()
-    )
+    print("autologin started")
 
+    # Schedule checks at a fixed period, regardless of how long they take
+    deadline = monotonic()
     while True:
+        # Cheap when the file didn't change, thanks to load_config's cache
+        try:
+            config = load_config(path)
+        except (OSError, ValueError, ConfigError) as error:
+            print(f"Could not reload {path!r}, keeping the previous config: {error}")
+        sleep_duration = config.update_period
         check_online(config)
-        print(f"Waiting for {sleep_duration}s before checking.")
-        sleep(sleep_duration)
+        deadline += sleep_duration
+        remaining = deadline - monotonic()
+        if remaining < -sleep_duration:
+            # We overran by more than a period, skip the missed checks
+            deadline = monotonic() + sleep_duration
+            remaining = sleep_duration
+        print(f"Waiting for {max(0, remaining):.0f}s before checking.")
+        sleep(max(0, remaining))
 
 
 if __name__ == "__main__":